@@ -0,0 +1,105 @@
+# Convert a batch of mkv files, the interactive selections are done first and then the files are encoded in parallel
+import os
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lib.conversion import ConversionError, clean_cancelled, convert_file, get_ffmpeg_settings, get_output_file, prepare, reload_config
+from lib.probe import prefetch_streams
+from lib.utils import delete_mkv, get_subtitle_file, print_red
+
+# Number of files encoded at the same time with the given encoder
+def get_workers(encoder: str, files_count: int) -> int:
+    if encoder.endswith("nvenc"):
+        # consumer NVIDIA cards accept a few encoding sessions at the same time
+        workers = 2
+    elif encoder.endswith(("amf", "qsv", "videotoolbox")):
+        workers = 1
+    else:
+        # x264/x265 are already multithreaded, oversubscribing the cpu only slows everything down
+        workers = (os.cpu_count() or 1) // 2
+    return max(1, min(workers, files_count))
+
+# Encode one prepared file, run by the workers
+def encode(filename: str, subtitle_file: str, audio_track: str, delete_after: bool, threads: int, progress: bool, remux: bool) -> None:
+    convert_file(filename, subtitle_file, audio_track, threads, progress, remux)
+    if delete_after and not delete_mkv(filename):
+        raise ConversionError(filename)
+
+# Convert the files, returns 1 if some of them failed and 0 otherwise
+def run_batch(filenames: list, delete_after: bool, audio_choice: str = None, remux: bool = False, subtitle_choice: str = None) -> int:
+    reload_config()
+    jobs = []
+    finished = set()
+    failed = []
+
+    # an interrupted directory can be converted again, only the files without their mp4 are probed and encoded
+    pending = []
+    for filename in filenames:
+        if get_output_file(filename).exists():
+            print(f"✅ \033[33m" + filename + "\033[0m has already been converted, delete its mp4 to convert it again")
+        else:
+            pending.append(filename)
+    prefetch = prefetch_streams(pending)
+
+    try:
+        # the prompts can't be answered while the encodes are running, so ask everything first
+        for filename in pending:
+            print("Checking file: " + filename + " ...")
+            subtitle_file = get_subtitle_file()
+            jobs.append((filename, subtitle_file, None))
+            audio_track = prepare(filename, subtitle_file, audio_choice, subtitle_choice)
+            if audio_track is None:
+                jobs.pop()
+            else:
+                jobs[-1] = (filename, subtitle_file, audio_track)
+
+        if not jobs:
+            return 0
+
+        encoder = get_ffmpeg_settings().encoder
+        workers = get_workers(encoder, len(jobs))
+        # split the cpu between the software encodes, hardware encoders keep the ffmpeg default
+        threads = max(1, (os.cpu_count() or 1) // workers) if workers > 1 and encoder.startswith("lib") else 0
+        if workers > 1:
+            print(f"⌛️ Encoding \033[33m{len(jobs)}\033[0m files, \033[33m{workers}\033[0m at a time ...")
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {
+                executor.submit(encode, filename, subtitle_file, audio_track, delete_after, threads, workers == 1, remux): filename
+                for filename, subtitle_file, audio_track in jobs
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except ConversionError:
+                    # the worker printed the error and removed its partial mp4, the other files go on
+                    failed.append(futures[future])
+                except Exception as e:
+                    print_red("    ❌ Failed to process file: " + futures[future])
+                    print_red("    ❌ Error: " + str(e))
+                    failed.append(futures[future])
+                finished.add(futures[future])
+                if workers > 1:
+                    print(f"⌛️ \033[33m{len(finished)}/{len(jobs)}\033[0m files done")
+        finally:
+            # the running ffmpeg processes received the interruption too, don't start the queued ones
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        if failed:
+            print_red(f"❌ {len(failed)} of {len(jobs)} files could not be converted:")
+            for filename in failed:
+                print_red("    " + filename)
+            return 1
+        return 0
+    except KeyboardInterrupt:
+        print_red("    ❌ Conversion cancelled")
+        for filename, subtitle_file, _ in jobs:
+            if filename not in finished:
+                clean_cancelled(filename, subtitle_file)
+        exit(1)
+    finally:
+        # drop the probes not started yet when the batch stops early
+        prefetch.shutdown(cancel_futures=True)
+        # every job has its own subtitle file, remove them even when a conversion failed
+        for _, subtitle_file, _ in jobs:
+            Path(subtitle_file).unlink(missing_ok=True)
@@ -1,4 +1,72 @@
-import configparser
+import re
+from functools import lru_cache
+from pathlib import Path
 
-config = configparser.ConfigParser()
-config.read('config.ini')
\ No newline at end of file
+# config.ini sits next to mk4.py, whatever the directory mk4 is launched from
+_CONFIG_FILE = Path(__file__).resolve().parent.parent / "config.ini"
+
+# Minimal INI parser, config.ini is only a couple of sections of key = value lines
+class FastConfigParser:
+    _SECTION_RE = re.compile(r'^\[([^\]]+)\][ \t]*$', re.M)
+    _KV_RE = re.compile(r'^[ \t]*([^=;#\s][^=\n]*?)[ \t]*=[ \t]*(.*?)[ \t]*$', re.M)
+
+    # the file is only read on the first lookup, importing the module doesn't touch the disk
+    def __init__(self, filename: Path = None) -> None:
+        self.sections = {}
+        self.filename = filename
+        self._mtime = None
+
+    # Parse the file, keys are upper-cased at insert so the lookups don't depend on the casing used in the file
+    # returns False when the file is missing or didn't change since the last read
+    def read(self, filename: Path) -> bool:
+        path = Path(filename)
+        try:
+            mtime = path.stat().st_mtime
+        except OSError:
+            return False
+
+        # the file didn't change since the last read, keep the parsed values
+        if filename == self.filename and mtime == self._mtime:
+            return False
+
+        sections = {}
+        # split gives [text before the first section, name, body, name, body, ...]
+        parts = self._SECTION_RE.split(path.read_text(encoding="utf-8"))
+        for name, body in zip(parts[1::2], parts[2::2]):
+            section = sections.setdefault(name.strip(), {})
+            for key, value in self._KV_RE.findall(body):
+                section[key.upper()] = value
+
+        self.sections = sections
+        self.filename = filename
+        self._mtime = mtime
+        get_config_value.cache_clear()
+        return True
+
+    # Re-read the config file only if it has been modified since the last read
+    def reload_if_changed(self) -> bool:
+        return self.filename is not None and self.read(self.filename)
+
+    def _ensure_loaded(self) -> None:
+        if self._mtime is None and self.filename is not None:
+            self.read(self.filename)
+
+    def get(self, section: str, default=None):
+        self._ensure_loaded()
+        return self.sections.get(section, default)
+
+    def __getitem__(self, section: str) -> dict:
+        self._ensure_loaded()
+        return self.sections[section]
+
+    def __contains__(self, section: str) -> bool:
+        self._ensure_loaded()
+        return section in self.sections
+
+# Get a value from the config, the key is case insensitive
+@lru_cache(maxsize=64)
+def get_config_value(section: str, key: str, default=None):
+    values = config.get(section)
+    return values.get(key.upper(), default) if values else default
+
+config = FastConfigParser(_CONFIG_FILE)
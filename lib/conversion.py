@@ -1,88 +1,338 @@
 # Convert the mkv file to mp4 with the beautified srt file and select the audio track
 import os
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 import subprocess
-from lib.subtitles import beautify_srt, extract_srt, has_subtitles, remove_font_balise
+import sys
+import time
+from typing import Optional
+from lib.subtitles import has_subtitles, prepare_subtitles
 from lib.utils import delete_mkv, get_file_name, get_subtitle_file, print_red
-from lib.config import config
+from lib.config import config, get_config_value
+from lib.encoders import encoder_accepts, get_encoder_codec, pick_encoder
+from lib.probe import choose_stream, get_streams
 
-def convert_file(filename: str, subtitles: str) -> None:
+# Resolve the encoder from the config, "auto" picks the best hardware encoder available
+def get_encoder() -> str:
+    encoder = get_config_value("FFMPEG", "ENCODER")
+    if encoder == "auto":
+        encoder = pick_encoder()
+    return encoder
+
+# x264 preset names mapped to the nvenc ones, from p1 (fastest) to p7 (best quality)
+NVENC_PRESETS = {
+    "ultrafast": "p1",
+    "superfast": "p1",
+    "veryfast": "p2",
+    "faster": "p3",
+    "fast": "p3",
+    "medium": "p4",
+    "slow": "p5",
+    "slower": "p6",
+    "veryslow": "p7",
+    "placebo": "p7",
+}
+
+# b-frames used as references give a better quality for the same bitrate, older NVIDIA cards (Pascal) don't support them
+NVENC_B_FRAMES = ("-bf", "2", "-refs", "1", "-b_ref_mode", "middle")
+
+# Get the rate control and preset options matching the encoder, the CRF value is used as the quality target
+def get_quality_options(encoder: str, quality: str, preset: str = "medium", tune: str = "") -> list:
+    if encoder.endswith("nvenc"):
+        nvenc_preset = preset if preset in NVENC_PRESETS.values() else NVENC_PRESETS.get(preset, "p4")
+        nvenc_tune = tune if tune in ("hq", "ll", "ull", "lossless") else "hq"
+        options = ["-preset", nvenc_preset, "-tune", nvenc_tune, "-rc", "vbr", "-cq", quality]
+        if encoder_accepts(encoder, NVENC_B_FRAMES):
+            options += NVENC_B_FRAMES
+        return options
+    if encoder.endswith("amf"):
+        return ["-quality", "balanced", "-rc", "cqp", "-qp_i", quality, "-qp_p", quality]
+    if encoder.endswith("qsv"):
+        return ["-global_quality", quality]
+    if encoder.endswith("videotoolbox"):
+        # videotoolbox has no constant quality mode, let it pick the bitrate
+        return []
+
+    options = []
+    if encoder in ("libx264", "libx265"):
+        options += ["-preset", preset]
+        if tune:
+            options += ["-tune", tune]
+    return options + ["-crf", quality]
+
+# ffmpeg settings resolved from the config, they are the same for every file of a batch
+@dataclass(frozen=True)
+class FfmpegSettings:
+    encoder: str
+    crf: str
+    preset: str
+    tune: str
+    quality_options: tuple
+    burn_subtitles: bool
+
+# Resolve the ffmpeg settings once, the cache is dropped when config.ini is re-read
+@lru_cache(maxsize=1)
+def get_ffmpeg_settings() -> FfmpegSettings:
+    encoder = get_encoder()
+    crf = get_config_value("FFMPEG", "CRF")
+    preset = get_config_value("FFMPEG", "PRESET", "medium")
+    tune = get_config_value("FFMPEG", "TUNE", "")
+    burn_subtitles = get_config_value("FFMPEG", "BURN_SUBTITLES", "true").lower() not in ("false", "no", "off", "0")
+    return FfmpegSettings(encoder, crf, preset, tune, tuple(get_quality_options(encoder, crf, preset, tune)), burn_subtitles)
+
+# Re-read config.ini if it has been modified and forget the settings resolved from it
+def reload_config() -> None:
+    if config.reload_if_changed():
+        get_ffmpeg_settings.cache_clear()
+
+# Get the codec of the first video stream of the file
+def get_video_codec(filename: str) -> str:
+    video_streams = get_streams(filename, "video")
+    return video_streams[0].get("codec_name", "") if video_streams else ""
+
+# Get the pixel format of the first video stream of the file
+def get_video_pix_fmt(filename: str) -> str:
+    video_streams = get_streams(filename, "video")
+    return video_streams[0].get("pix_fmt", "") if video_streams else ""
+
+# codecs and pixel formats NVDEC decodes on every card, the frames can stay on the gpu as nv12
+# anything else (10-bit p010, 4:2:2, 4:4:4, or a codec decoded on the cpu) can't be downloaded with format=nv12
+CUDA_FRAMES_CODECS = ("h264", "hevc")
+CUDA_FRAMES_PIX_FMTS = ("yuv420p", "yuvj420p", "nv12")
+
+# Get the codec of the audio track selected with select_audio_track ("0:a:N")
+def get_audio_codec(filename: str, audio_track: str) -> str:
+    index = int(audio_track.rpartition(":")[2])
+    audio_streams = probe_audio_tracks(filename)
+    return audio_streams[index].get("codec_name", "") if index < len(audio_streams) else ""
+
+# Get the hardware decoding options matching the encoder, so the frames are decoded by the same GPU
+def get_decode_options(encoder: str, filename: str) -> list:
+    if not encoder.endswith(("nvenc", "amf", "qsv")):
+        return []
+
+    # av1 hardware decoding gives empty outputs on older NVIDIA cards (Pascal/Turing), keep it on the cpu
+    if get_video_codec(filename) == "av1":
+        return []
+
+    if encoder.endswith("nvenc"):
+        if get_video_codec(filename) in CUDA_FRAMES_CODECS and get_video_pix_fmt(filename) in CUDA_FRAMES_PIX_FMTS:
+            return ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"]
+        # ffmpeg downloads the decoded frames itself, the normal subtitles filter works on them
+        return ["-hwaccel", "cuda"]
+    if encoder.endswith("amf"):
+        return ["-hwaccel", "d3d11va" if os.name == "nt" else "vaapi"]
+    return ["-hwaccel", "qsv"]
+
+# List the audio tracks of the file with ffprobe (much lighter than starting ffmpeg to parse its stderr)
+def probe_audio_tracks(filename: str) -> list:
+    return get_streams(filename, "audio")
+
+# Format an audio track from ffprobe for the selection prompt
+def format_audio_track(track: dict) -> str:
+    tags = track.get("tags", {})
+    line = f"({tags.get('language', 'und').upper()}): {track.get('codec_name', 'unknown')}, {track.get('channels', '?')} channels"
+    if "title" in tags:
+        line += " - " + tags["title"]
+    return line
+
+# Ask the user which audio track to use when the file has more than one
+# the choice given on the command line ("auto", "default", a track number or a language code) replaces the prompt
+# a track number the file doesn't have falls back to the default track
+def select_audio_track(filename: str, choice: str = None) -> str:
+    if choice == "auto":
+        return "0:a:0"
+
+    audio_tracks = probe_audio_tracks(filename)
+    if choice is not None:
+        return "0:a:" + str(choose_stream(audio_tracks, choice))
+    if len(audio_tracks) <= 1:
+        return "0:a:0"
+    # nobody can answer the prompt when the input is piped or redirected, take the default audio track
+    if not sys.stdin.isatty():
+        return "0:a:" + str(choose_stream(audio_tracks, "default"))
+
+    print(f"    ⌛️ \033[33m" + filename + "\033[0m has multiple audio tracks, please select the one you want to use: ")
+    for i, track in enumerate(audio_tracks):
+        print(f"            \033[33m{i}\033[0m: {format_audio_track(track)}")
+    while True:
+        try:
+            selected_audio_track = int(input("    Please select the audio track you want to use: "))
+            if selected_audio_track < 0 or selected_audio_track >= len(audio_tracks):
+                print_red("    ❌ Please select a valid audio track")
+            else:
+                break
+        except ValueError:
+            print_red("    ❌ Please select a valid audio track")
+    return "0:a:" + str(selected_audio_track)
+
+# seconds between two progress lines of a file encoded in parallel with others
+PROGRESS_INTERVAL = 60
+
+# Show the progress ffmpeg writes on `-progress pipe:1`, the line is refreshed once per key=value block
+# with a filename the files are encoded in parallel, so a full line naming the file is printed every PROGRESS_INTERVAL seconds instead
+# the pipe is read as bytes, only the displayed values are decoded
+def show_progress(process: subprocess.Popen, filename: str = None) -> None:
+    block = {}
+    next_line = time.monotonic() + PROGRESS_INTERVAL
+    for line in process.stdout:
+        key, _, value = line.rstrip().partition(b"=")
+        block[key] = value
+        if key == b"progress":
+            # out_time_ms is in microseconds too, older ffmpeg versions only have this one
+            out_time = block.get(b"out_time_us") or block.get(b"out_time_ms")
+            if out_time and out_time.isdigit():
+                seconds = int(out_time) // 1000000
+                speed = block.get(b"speed", b"N/A").strip().decode()
+                encoded = f"\033[33m{seconds // 3600:02}:{seconds // 60 % 60:02}:{seconds % 60:02}\033[0m encoded ({speed})"
+                if filename is None:
+                    # \033[K erases what a longer previous line left after the cursor
+                    print(f"\r    ⌛️ {encoded}\033[K", end="", flush=True)
+                elif time.monotonic() >= next_line:
+                    print(f"    ⌛️ \033[33m{filename}\033[0m: {encoded}", flush=True)
+                    next_line = time.monotonic() + PROGRESS_INTERVAL
+            if value == b"end":
+                break
+            block.clear()
+    if filename is None:
+        print()
+
+# options starting every conversion command, built once instead of for every file
+FFMPEG_PREFIX = ("ffmpeg", "-y", "-hide_banner", "-v", "error", "-nostats")
+PROGRESS_OPTIONS = ("-progress", "pipe:1")
+
+# Get the mp4 created from the mkv file
+def get_output_file(filename: str) -> Path:
+    return Path(get_file_name(filename) + "-mk4.mp4")
+
+# ffmpeg writes the mp4 to this file, it is renamed once the conversion succeeded so an existing mp4 is always complete
+def get_partial_file(filename: str) -> Path:
+    output = get_output_file(filename)
+    return output.with_name(output.name + ".tmp")
+
+# Raised when a file could not be converted or deleted, the error has already been printed
+class ConversionError(Exception):
+    pass
+
+def convert_file(filename: str, subtitles: str, audio_track: str, threads: int = 0, progress: bool = True, remux: bool = False) -> None:
     try:
         print(f"    ⌛️ Converting file: \033[33m" + filename + "\033[0m to mp4 ...")
 
-        # check if the mkv file have multiple audio tracks and ask the user which one to use
-        result = subprocess.run(["ffmpeg", "-i", filename], capture_output=True, text=True)
-        audio_tracks = [line for line in result.stderr.splitlines() if "Audio:" in line or "audio:" in line]
-        if len(audio_tracks) > 1:
-            print(f"    ⌛️ \033[33m" + filename + "\033[0m has multiple audio tracks, please select the one you want to use: ")
-            for i, line in enumerate(audio_tracks):
-                print(f"            \033[33m{i}\033[0m: {line}")
-            while True:
-                try:
-                    selected_audio_track = int(input("    Please select the audio track you want to use: "))
-                    if selected_audio_track < 0 or selected_audio_track >= len(audio_tracks):
-                        print_red("    ❌ Please select a valid audio track")
-                    else:
-                        break
-                except ValueError:
-                    print_red("    ❌ Please select a valid audio track")
-            audio_track = "0:a:" + str(selected_audio_track)
+        output = get_partial_file(filename)
+        settings = get_ffmpeg_settings()
+        encoder = settings.encoder
+        # aac is what the mp4 gets anyway, copy the track instead of encoding it again
+        audio_codec = "copy" if get_audio_codec(filename, audio_track) == "aac" else "aac"
+
+        # the video already has the codec of the encoder, copy it and add the subtitles as a track instead of burning them
+        if (remux or not settings.burn_subtitles) and get_video_codec(filename) == get_encoder_codec(encoder):
+            print(f"    ⌛️ Copying the video and adding the subtitles as a track ...")
+            ffmpeg_cmd = [
+                *FFMPEG_PREFIX,
+                *PROGRESS_OPTIONS,
+                "-i", str(filename),
+                "-i", subtitles,
+                "-c:v", "copy",
+                "-c:a", audio_codec,
+                "-c:s", "mov_text",
+                "-map", "0:v:0",
+                "-map", audio_track,
+                "-map", "1:s:0",
+                "-movflags", "+faststart",
+                "-f", "mp4",
+                str(output)
+            ]
         else:
-            audio_track = "0:a:0"
-        
-        output = Path(get_file_name(filename) + "-mk4.mp4")
-        
-        subprocess.run([
-            "ffmpeg",
-            "-y",
-            "-hide_banner",
-            "-v", "error",
-            "-stats",
-            "-i", str(filename),
-            "-vf", "subtitles=" + subtitles,
-            "-c:v", config['FFMPEG']["ENCODER"],
-            "-pix_fmt", "yuv420p",
-            "-crf", config['FFMPEG']["CRF"],
-            "-c:a", "aac",
-            "-map", audio_track,
-            "-map", "0:v:0",
-
-            # keeping the below lines only for dev mode. please keep them commented
-            # "-ss", "00:00:00",
-            # "-to", "00:00:20",
-            str(output)
-        ])
-        os.remove(subtitles)
+            print(f"    ⌛️ Encoding with: \033[33m" + encoder + "\033[0m")
+
+            decode_options = get_decode_options(encoder, filename)
+
+            # cuda frames stay on the gpu, download them for the subtitles burn-in and upload them back for nvenc
+            if "-hwaccel_output_format" in decode_options:
+                video_filter = "hwdownload,format=nv12,subtitles=" + subtitles + ",hwupload_cuda"
+                pixel_format = []
+            else:
+                video_filter = "subtitles=" + subtitles
+                pixel_format = ["-pix_fmt", "yuv420p"]
+
+            # share the cpu between the files encoded at the same time, software encoders use all the cores otherwise
+            thread_options = ["-threads", str(threads)] if threads or encoder.startswith("lib") else []
+
+            ffmpeg_cmd = [
+                *FFMPEG_PREFIX,
+                *PROGRESS_OPTIONS,
+                *decode_options,
+                "-i", str(filename),
+                "-vf", video_filter,
+                "-c:v", encoder,
+                *pixel_format,
+                *settings.quality_options,
+                *thread_options,
+                "-c:a", audio_codec,
+                "-map", audio_track,
+                "-map", "0:v:0",
+                # put the index at the start of the mp4 so it can be streamed without a remux
+                "-movflags", "+faststart",
+
+                # keeping the below lines only for dev mode. please keep them commented
+                # "-ss", "00:00:00",
+                # "-to", "00:00:20",
+                "-f", "mp4",
+                str(output)
+            ]
+
+        # the live progress line only works when a single file is encoded, the parallel encodes print a line from time to time
+        process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, bufsize=1 << 20)
+        show_progress(process, None if progress else filename)
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, "ffmpeg")
+        os.replace(output, get_output_file(filename))
         print(f"    ✅ File: \033[33m" + filename + "\033[0m has been converted")
     except Exception as e:
+        get_partial_file(filename).unlink(missing_ok=True)
         print_red("    ❌ Failed to convert file: " + filename)
         print_red("    ❌ Error: " + str(e))
-        exit(1)
+        # the batch workers run in threads, let the caller decide to stop or to go on with the other files
+        raise ConversionError(filename) from e
+
+# Do all the interactive steps before the encoding, returns the audio track to use or None if the file has no subtitles
+def prepare(filename: str, subtitle_file: str, audio_choice: str = None, subtitle_choice: str = None) -> Optional[str]:
+    if not has_subtitles(filename):
+        print(f"    ❌ \033[33m" + filename + "\033[0m has no subtitles")
+        return None
+
+    print(f"    ✅ \033[33m" + filename + "\033[0m has subtitles")
+    prepare_subtitles(filename, subtitle_file, subtitle_choice)
+    return select_audio_track(filename, audio_choice)
+
+# Remove the temporary subtitle file and the partial mp4 of a cancelled conversion
+def clean_cancelled(filename: str, subtitle_file: str) -> None:
+    Path(subtitle_file).unlink(missing_ok=True)
+    get_partial_file(filename).unlink(missing_ok=True)
 
 # process to the conversion from mkv to mp4
-def process(filename: str, delete: bool) -> None:
+def process(filename: str, delete: bool, audio_choice: str = None, remux: bool = False, subtitle_choice: str = None) -> None:
+    # pick up the changes made to config.ini between two files
+    reload_config()
     subtitle_file = get_subtitle_file()
 
-    if not has_subtitles(filename):
-        print(f"    ❌ \033[33m" + filename + "\033[0m has no subtitles")
-    else:
-        try:
-            print(f"    ✅ \033[33m" + filename + "\033[0m has subtitles")
-            extract_srt(filename, subtitle_file)
-            remove_font_balise(subtitle_file)
-            beautify_srt(subtitle_file)
-            convert_file(filename, subtitle_file)
-            if delete:
-                delete_mkv(filename)
-        except KeyboardInterrupt:
-            print_red("    ❌ Conversion cancelled")
-            mk4_filename = Path(get_file_name(filename) + "-mk4.mp4")
-            if os.path.exists(subtitle_file):
-                os.remove(subtitle_file)
-            if os.path.exists(mk4_filename):
-                os.remove(mk4_filename)
-            exit(1)
-        except Exception as e:
-            print_red("    ❌ Failed to process file: " + filename)
-            print_red("    ❌ Error: " + str(e))
-            exit(1)
\ No newline at end of file
+    try:
+        audio_track = prepare(filename, subtitle_file, audio_choice, subtitle_choice)
+        if audio_track is not None:
+            convert_file(filename, subtitle_file, audio_track, remux=remux)
+            if delete and not delete_mkv(filename):
+                exit(1)
+    except KeyboardInterrupt:
+        print_red("    ❌ Conversion cancelled")
+        clean_cancelled(filename, subtitle_file)
+        exit(1)
+    except ConversionError:
+        exit(1)
+    except Exception as e:
+        print_red("    ❌ Failed to process file: " + filename)
+        print_red("    ❌ Error: " + str(e))
+        exit(1)
+    finally:
+        # the subtitle file is only needed by this job, remove it whether the conversion succeeded or not
+        Path(subtitle_file).unlink(missing_ok=True)
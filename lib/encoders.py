@@ -0,0 +1,119 @@
+import json
+import os
+import subprocess
+from pathlib import Path
+from lib.utils import find_program
+
+# hardware encoders mk4 knows how to drive, by codec and in order of preference
+HW_ENCODERS = {
+    "h264": ("h264_nvenc", "h264_amf", "h264_qsv", "h264_videotoolbox"),
+    "hevc": ("hevc_nvenc", "hevc_amf"),
+}
+
+# software fallback for each codec
+SW_ENCODERS = {
+    "h264": "libx264",
+    "hevc": "libx265",
+}
+
+# Get the codec produced by the encoder, None for the encoders mk4 doesn't know
+def get_encoder_codec(encoder: str) -> str:
+    for codec, encoders in HW_ENCODERS.items():
+        if encoder in encoders or encoder == SW_ENCODERS[codec]:
+            return codec
+    return None
+
+# the encoders compiled into ffmpeg only change with the ffmpeg binary, they are saved between runs
+_CACHE_FILE = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "mk4" / "encoders.json"
+
+# encoders list, loaded from the cache file once per run
+_cache = {}
+
+# results of the test encodes, only kept for this run
+# a GPU or a driver can be added, removed or break between two runs without ffmpeg changing
+_accepts = {}
+
+# Identify the installed ffmpeg, the saved encoders list is dropped when it is replaced
+def _ffmpeg_id() -> str:
+    path = find_program("ffmpeg")
+    if path is None:
+        return ""
+    stat = os.stat(path)
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+# Load the encoders list saved by a previous run with the same ffmpeg
+def _load_cache() -> dict:
+    if not _cache:
+        ffmpeg_id = _ffmpeg_id()
+        try:
+            with open(_CACHE_FILE, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = {}
+        if not isinstance(saved, dict) or saved.get("ffmpeg") != ffmpeg_id:
+            saved = {"ffmpeg": ffmpeg_id}
+        # older cache files saved the test encodes too, they are done again on every run
+        saved.pop("accepts", None)
+        _cache.update(saved)
+    return _cache
+
+# Save the encoders list for the next runs, a failure only means listing them again next time
+def _save_cache() -> None:
+    try:
+        _CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = _CACHE_FILE.with_name(f"{_CACHE_FILE.name}.{os.getpid()}.tmp")
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(_cache, f)
+        os.replace(temp_file, _CACHE_FILE)
+    except OSError:
+        pass
+
+# List the encoders compiled into the installed ffmpeg (`ffmpeg -encoders` is parsed only once)
+def detect_encoders() -> set:
+    cache = _load_cache()
+    if "encoders" not in cache:
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], stdin=subprocess.DEVNULL, capture_output=True, text=True)
+        encoders = []
+        for line in result.stdout.splitlines():
+            # lines look like " V....D h264_nvenc           NVIDIA NVENC H.264 encoder (codec h264)"
+            parts = line.split()
+            if len(parts) > 1 and parts[0].startswith("V"):
+                encoders.append(parts[1])
+        cache["encoders"] = encoders
+        _save_cache()
+    return set(cache["encoders"])
+
+# Check with a tiny test encode that the encoder works on this machine with the given options, only the exit code matters so the output is discarded
+def encoder_accepts(encoder: str, options: tuple = ()) -> bool:
+    key = " ".join((encoder, *options))
+    if key not in _accepts:
+        result = subprocess.run([
+            "ffmpeg",
+            "-hide_banner",
+            "-v", "error",
+            "-f", "lavfi",
+            "-i", "color=black:s=256x256:d=0.1",
+            "-c:v", encoder,
+            *options,
+            "-f", "null", "-"
+        ], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _accepts[key] = result.returncode == 0
+    return _accepts[key]
+
+# Check that a hardware encoder really works on this machine, ffmpeg lists nvenc/amf/qsv even without the matching GPU
+def has_gpu_for(encoder: str) -> bool:
+    return encoder_accepts(encoder)
+
+# Pick the best available encoder for the given codec, falling back to the software one
+def pick_encoder(preference: str = "h264") -> str:
+    available = detect_encoders()
+    tried = []
+    for encoder in HW_ENCODERS.get(preference, ()):
+        if encoder in available:
+            if has_gpu_for(encoder):
+                return encoder
+            tried.append(encoder)
+    fallback = SW_ENCODERS.get(preference, "libx264")
+    if tried:
+        print(f"    ⚠️ No hardware encoder works on this machine ({', '.join(tried)}), encoding with \033[33m{fallback}\033[0m")
+    return fallback
@@ -0,0 +1,75 @@
+# Read the streams of the media files with ffprobe, a file is probed only once as long as it doesn't change
+import json
+import os
+import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# probes of this run by file, size and modification time, a replaced file is probed again
+# a probe still running is awaited instead of started a second time, only the files of this run are kept
+_probes = {}
+_probes_lock = threading.Lock()
+
+# Run ffprobe on the file
+def _probe(filename: str) -> dict:
+    result = subprocess.run([
+        "ffprobe",
+        "-v", "error",
+        "-show_entries", "stream=index,codec_name,codec_type,pix_fmt,channels:stream_tags=language,title:stream_disposition=default",
+        "-of", "json",
+        filename
+    ], stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    # group the streams by type once, every lookup after that is a dict access
+    streams = {}
+    for stream in json.loads(result.stdout or "{}").get("streams", []):
+        streams.setdefault(stream.get("codec_type"), []).append(stream)
+    return streams
+
+# Get the streams of the file by type, as the dicts given by ffprobe
+def probe_streams(filename: str) -> dict:
+    stat = os.stat(filename)
+    key = (filename, stat.st_size, stat.st_mtime_ns)
+    with _probes_lock:
+        future = _probes.get(key)
+        running = future is None
+        if running:
+            future = _probes[key] = Future()
+    if running:
+        try:
+            future.set_result(_probe(filename))
+        except BaseException as e:
+            # a failed or interrupted probe is run again by the next caller
+            with _probes_lock:
+                del _probes[key]
+            future.set_exception(e)
+            raise
+    return future.result()
+
+# Get the streams of the given type ("video", "audio" or "subtitle") in the order ffmpeg numbers them
+# the list belongs to the cache, callers must not modify it
+def get_streams(filename: str, codec_type: str) -> list:
+    return probe_streams(filename).get(codec_type, [])
+
+# Pick the stream matching a choice given on the command line, returns its index among the streams
+# the choice is a track number, a language code of the ffprobe tags ("jpn", "eng" ...) or "default" for the stream flagged as default
+# a track number or a language missing from the file falls back to the default stream, and then to the first one
+def choose_stream(streams: list, choice: str) -> int:
+    if choice.isdigit() and int(choice) < len(streams):
+        return int(choice)
+    if choice != "default":
+        for i, stream in enumerate(streams):
+            if stream.get("tags", {}).get("language", "").lower() == choice.lower():
+                return i
+    for i, stream in enumerate(streams):
+        if stream.get("disposition", {}).get("default"):
+            return i
+    return 0
+
+# Probe the files in the background, the ffprobe runs overlap each other and the prompts of the first files
+# the results land in the cache, shut the returned executor down with cancel_futures to drop the remaining probes
+def prefetch_streams(filenames: list) -> ThreadPoolExecutor:
+    executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+    for filename in filenames:
+        executor.submit(probe_streams, filename)
+    executor.shutdown(wait=False)
+    return executor
@@ -1,109 +1,134 @@
+import os
 import re
 import subprocess
+import sys
+from pathlib import Path
 from lib.utils import print_red
-from lib.config import config
+from lib.config import get_config_value
+from lib.probe import choose_stream, get_streams
 
-# Check if the file has subtitles
-def has_subtitles(filename: str) -> None:
+# Check if the file has subtitles, the streams come from the cached ffprobe of the file
+def has_subtitles(filename: str) -> bool:
     print(f"    ⌛️ Checking if file: \033[33m" + filename + "\033[0m has subtitles ...")
-    result = subprocess.run(["ffmpeg", "-i", filename], capture_output=True, text=True)
+    return len(get_streams(filename, "subtitle")) > 0
 
-    # Check if the file contains srts
-    return "Subtitle:" in result.stderr or "subtitle:" in result.stdout
+# Format a subtitle stream from ffprobe for the selection prompt
+def format_subtitle_track(track: dict) -> str:
+    tags = track.get("tags", {})
+    line = f"({tags.get('language', 'und').upper()}): {track.get('codec_name', 'unknown')}"
+    if "title" in tags:
+        line += " - " + tags["title"]
+    if track.get("disposition", {}).get("default"):
+        line += " (default)"
+    return line
+
+# Ask the user which subtitle to use when the file has more than one, returns its index among the subtitle streams
+# the choice given on the command line ("auto", "default", a track number or a language code) replaces the prompt
+def select_subtitle(filename: str, choice: str = None) -> int:
+    if choice == "auto":
+        return 0
+
+    # list the subtitles of the mkv file from its cached ffprobe streams
+    subtitles = get_streams(filename, "subtitle")
+    if choice is not None:
+        return choose_stream(subtitles, choice)
+    if len(subtitles) <= 1:
+        return 0
+    # nobody can answer the prompt when the input is piped or redirected, take the default subtitle
+    if not sys.stdin.isatty():
+        return choose_stream(subtitles, "default")
+
+    # if there is more than one subtitle, ask the user which one to use for the mp4 video
+    print(f"    ⌛️ \033[33m" + filename + "\033[0m has multiple subtitles, please select the one you want to use:")
+
+    # print the subtitles list
+    for i, track in enumerate(subtitles):
+        print(f"            \033[33m{i}\033[0m: {format_subtitle_track(track)}")
+
+    # ask the user to select the subtitle
+    while True:
+        try:
+            selected_subtitle = int(input("    Please select the subtitle you want to use: "))
+            if selected_subtitle < 0 or selected_subtitle >= len(subtitles):
+                print_red("    ❌ Please select a valid subtitle")
+            else:
+                return selected_subtitle
+        except ValueError:
+            print_red("    ❌ Please select a valid subtitle")
 
 # Extract the srt file from the mkv file
 def extract_srt(filename: str, subtitle_file: str) -> None:
     try:
         print(f"    ⌛️ Extracting srt from \033[33m" + filename + "\033[0m ...")
-
-        # check all the subtitles in the mkv file
-        result = subprocess.run(["ffmpeg", "-i", filename], capture_output=True, text=True)
-        subtitles = [line for line in result.stderr.splitlines() if "Subtitle:" in line or "subtitle:" in line]
-
-        # if there is more than one subtitle, ask the user which one to use for the mp4 video
-        if len(subtitles) > 1:
-            print(f"    ⌛️ \033[33m" + filename + "\033[0m has multiple subtitles, please select the one you want to use:")
-            # get the subtitles list
-            subtitles = [line for line in result.stderr.splitlines() if "Subtitle:" in line or "subtitle:" in line]
-
-            # print the subtitles list
-            for i, line in enumerate(subtitles):
-                parts = line.split(':')
-                language = parts[1].strip()
-                languages = language.split('(')
-                code = languages[1][:-1].upper()
-                stream = f"({code}): {parts[2]}: {parts[3]}"
-                print(f"            \033[33m{i}\033[0m: {stream}")
-
-            # ask the user to select the subtitle
-            while True:
-                try:
-                    selected_subtitle = int(input("    Please select the subtitle you want to use: "))
-                    if selected_subtitle < 0 or selected_subtitle >= len(subtitles):
-                        print_red("    ❌ Please select a valid subtitle")
-                    else:
-                        break
-                except ValueError:
-                    print_red("    ❌ Please select a valid subtitle")
-
-            # extract the selected subtitle
-            subprocess.run([
-                "ffmpeg",
-                "-y",
-                "-hide_banner",
-                "-loglevel", "error",
-                "-i", filename,
-                "-c", "srt",
-                "-map", "0:s:" + str(selected_subtitle),
-                subtitle_file
-            ])
-        else:
-            subprocess.run([
-                    "ffmpeg",
-                    "-y",
-                    "-hide_banner",
-                    "-loglevel", "error",
-                    "-i", filename,
-                    "-c", "srt",
-                    "-map", "0:s:0",
-                    subtitle_file
-            ])
+        subprocess.run([
+            "ffmpeg",
+            "-y",
+            "-hide_banner",
+            "-loglevel", "error",
+            "-i", filename,
+            "-c", "srt",
+            "-map", "0:s:" + str(select_subtitle(filename)),
+            subtitle_file
+        ], stdin=subprocess.DEVNULL)
     except Exception as e:
         print_red("    ❌ Failed to extract srt from: " + filename)
         print_red("    ❌ Error: " + str(e))
         exit(1)
 
+# Read a subtitle stream of the mkv file as srt, without writing it to the disk
+def read_srt(filename: str, subtitle: int) -> str:
+    result = subprocess.run([
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel", "error",
+        "-i", filename,
+        "-c", "srt",
+        "-map", "0:s:" + str(subtitle),
+        "-f", "srt",
+        "pipe:1"
+    ], stdin=subprocess.DEVNULL, capture_output=True, text=True, encoding="utf-8", check=True)
+    return result.stdout
+
+# an srt cue: its number, its timing line and the dialog lines until the blank line separating it from the next cue
+_CUE_RE = re.compile(r'^([^\S\n]*\d+[^\S\n]*\n.*(?:\n|\Z))((?:.+(?:\n|\Z))*)', re.M)
+
+# the font balises already in the subtitles, [^>]* can't backtrack past the end of the tag
+_FONT_STRIP_RE = re.compile(r'<font[^>]*>|</font>', re.I)
+
+# Add font balises around every dialog of the srt content
+# with strip_fonts the existing font balises of the dialogs are removed in the same pass
+def beautify(content: str, strip_fonts: bool = False) -> str:
+    font = "<font size=\"{}\" face=\"{}\">".format(get_config_value("FONT", "SIZE"), get_config_value("FONT", "NAME"))
+    # the regex engine walks the cues instead of a python loop over every line
+    return "".join(
+        f"{cue.group(1)}{font}{_FONT_STRIP_RE.sub('', cue.group(2)) if strip_fonts else cue.group(2)}</font>\n\n"
+        for cue in _CUE_RE.finditer(content)
+    )
+
+# Remove the font balises of the srt content (if any) to avoid double font balises in the final file
+def strip_font_balises(content: str) -> str:
+    return _FONT_STRIP_RE.sub("", content)
+
+# Write the srt through a temporary file renamed over it, an interruption never leaves a truncated srt
+def write_srt(subtitle_file: str, content: str) -> None:
+    temp_file = subtitle_file + ".tmp"
+    try:
+        with open(temp_file, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(temp_file, subtitle_file)
+    finally:
+        # only left behind when the write failed
+        Path(temp_file).unlink(missing_ok=True)
+
 # Beautify the srt file by adding font balises
 def beautify_srt(filename: str) -> None:
     try:
         print(f"    ⌛️ Beautifying subtitles: \033[33m" + filename + "\033[0m ...")
         with open(filename, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        formatted_lines = []
-        line_num = 0
-
-        # Add font balises to the srt file
-        while line_num < len(lines):
-            # Check if the line is a number (subtitle number)
-            if lines[line_num].strip().isdigit():
-                formatted_lines.append(lines[line_num])
-                formatted_lines.append(lines[line_num + 1])
-                line_num += 2
-                dialog = ''
-                # Add the dialog to the formatted line until we reach a new line
-                while line_num < len(lines) and lines[line_num] != '\n':
-                    dialog += lines[line_num]
-                    line_num += 1
-                # Add the font balises to the dialog and add it to the formatted lines list
-                formatted_line = "<font size=\"{}\" face=\"{}\">{}</font>".format(config['FONT']["Size"], config["FONT"]["Name"], dialog)
-                formatted_lines.append(formatted_line)
-                formatted_lines.append('\n\n')
-            else:
-                line_num += 1
-        with open(filename, "w", encoding="utf-8") as f:
-            # Write the formatted lines to the srt file
-            for line in formatted_lines:
-                f.write(line)
+            content = f.read()
+
+        # Write the formatted lines to the srt file
+        write_srt(filename, beautify(content))
 
         print(f"    ✅ \033[33m" + filename + "\033[0m has been beautified")
     except Exception as e:
@@ -118,14 +143,21 @@ def remove_font_balise(subtitle_file: str) -> None:
         with open(subtitle_file, "r", encoding="utf-8") as f:
             lines = f.read()
 
-        # Remove font balises from the srt file (if any) to avoid double font balises in the final file
-        pattern = r"<font.*?>|</font>"
-        lines = re.sub(pattern, "", lines)
-
-        with open(subtitle_file, "w", encoding="utf-8") as f:
-            f.write(lines)
+        write_srt(subtitle_file, strip_font_balises(lines))
         print(f"    ✅ Font balises has been removed from file: \033[33m" + subtitle_file+"\033[0m")
     except Exception as e:
         print_red("    ❌ Failed to remove font balises from subtitles: " + subtitle_file)
         print_red("    ❌ Error: " + str(e))
         exit(1)
+
+# Extract the subtitles of the mkv file, remove their font balises and beautify them in memory, the srt file is written only once
+def prepare_subtitles(filename: str, subtitle_file: str, subtitle_choice: str = None) -> None:
+    try:
+        print(f"    ⌛️ Extracting and beautifying subtitles from \033[33m" + filename + "\033[0m ...")
+        content = read_srt(filename, select_subtitle(filename, subtitle_choice))
+        write_srt(subtitle_file, beautify(content, strip_fonts=True))
+        print(f"    ✅ Subtitles have been beautified into \033[33m" + subtitle_file + "\033[0m")
+    except Exception as e:
+        print_red("    ❌ Failed to prepare the subtitles of: " + filename)
+        print_red("    ❌ Error: " + str(e))
+        exit(1)
@@ -1,25 +1,58 @@
 import os
+import secrets
+import shutil
+from functools import lru_cache
 
 def print_red(text: str) -> None:
     print(f"\033[31m{text}\033[0m")
 
+# Check if the file has the mkv extension, whatever its case
+def is_mkv(filename: str) -> bool:
+    return filename[-4:].lower() == ".mkv"
+
 # Get the file name without the extension
 def get_file_name(filename: str) -> str:
     return os.path.splitext(filename)[0]
 
+# Find the path of a program in the PATH, the lookup is done once per program and run
+@lru_cache(maxsize=None)
+def find_program(name: str) -> str:
+    return shutil.which(name)
+
+# check that ffmpeg and ffprobe are both installed, the result doesn't change during a run
+def is_ffmpeg_installed() -> bool:
+    return find_program("ffmpeg") is not None and find_program("ffprobe") is not None
+
+# Recursively list the mkv files of a directory, os.scandir gives the entry type without an extra stat per file
+def find_mkv_files(directory: str) -> list:
+    mkv_files = []
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        # skip the directories that can't be read, like os.walk does
+        return mkv_files
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                mkv_files += find_mkv_files(entry.path)
+            elif is_mkv(entry.name) and entry.is_file():
+                mkv_files.append(entry.path)
+    return mkv_files
+
 # generate a random name for the srt file
 def get_subtitle_file() -> str:
-    return "subtitle-" + str(os.urandom(6).hex()) + ".srt"
+    return f"subtitle-{secrets.token_hex(6)}.srt"
 
-# manage the -r flag
-def delete_mkv(filename: str) -> None:
+# manage the -r flag, returns False if the file could not be deleted
+def delete_mkv(filename: str) -> bool:
     print(f"    ⌛️ Deleting: \033[33m" + filename + "\033[0m ...")
     try:
         # delete the file if it's a valid mkv file
-        if os.path.isfile(filename) and (filename.endswith(".mkv") or filename.endswith(".MKV")):
+        if os.path.isfile(filename) and is_mkv(filename):
             os.remove(filename)
             print(f"    🗑️ \033[33m" + filename + "\033[0m has been deleted!")
     except Exception as e:
         print_red("❌ Failed to delete file: " + filename)
         print_red("❌ Error: " + str(e))
-        exit(1)
\ No newline at end of file
+        return False
+    return True
\ No newline at end of file
@@ -1,9 +1,10 @@
 from pathlib import Path
-import shutil
 import sys
 import os
-from lib.utils import print_red
+import stat
+from lib.utils import find_mkv_files, is_ffmpeg_installed, is_mkv, print_red
 from lib.conversion import process
+from lib.batch import run_batch
 
 def documentation() -> None:
     print("documentation todo :) :) :) :) :) ;)")
@@ -11,8 +12,8 @@ def documentation() -> None:
 def main() -> int:
 
     # check if ffmpeg is installed
-    if not shutil.which("ffmpeg"):
-        sys.exit(print_red("❌ Ffmpeg is not installed, please install it before using mk4.py"))
+    if not is_ffmpeg_installed():
+        sys.exit(print_red("❌ Ffmpeg is not installed, please install it (with ffprobe) before using mk4.py"))
 
     # check if the user has passed a file
     if len(sys.argv) < 2:
@@ -22,42 +23,60 @@ def main() -> int:
     if sys.argv[1] == "--help":
         sys.exit(documentation())
 
+    # --audio-track and --subtitle-track select the tracks of every file without asking
+    # auto takes the first track, default the track flagged as default, N the track number N, or a language code (jpn, eng ...)
+    choices = {"--audio-track": None, "--subtitle-track": None}
+    for arg in sys.argv[1:]:
+        option, _, value = arg.partition("=")
+        if option in choices:
+            if value != "auto" and not value.isdigit() and not value.isalpha():
+                sys.exit(print_red("❌ " + option + " must be auto, default, a track number or a language code"))
+            choices[option] = value
+    audio_choice = choices["--audio-track"]
+    subtitle_choice = choices["--subtitle-track"]
+
+    # --remux-if-possible copies the video when it already has the codec of the encoder and adds the subtitles as a track
+    remux = "--remux-if-possible" in sys.argv
+
+    status = 0
     for i in range(1, len(sys.argv)):
 
-        # if the argument is a -r flag, ignore it
-        if sys.argv[i] == "-r":
+        # if the argument is a -r flag or an option, ignore it
+        if sys.argv[i] in ("-r", "--remux-if-possible") or sys.argv[i].startswith(("--audio-track=", "--subtitle-track=")):
             continue
 
         try:
             # check if the next argument is a -r
             delete = i + 1 < len(sys.argv) and sys.argv[i + 1] == "-r"
          
-            # if the argument is a directory, recursively check all the mkv files in the directory
-            if os.path.isdir(sys.argv[i]):
-                for root, dirs, files in os.walk(sys.argv[i]):
-                    for file in files:
-                        if (file.endswith(".mkv") or file.endswith(".MKV")):
-                            print("Checking file: " + file + " ...")
-                            process(os.path.join(root, file), delete)
+            # a single stat tells if the argument is a directory, a file or doesn't exist
+            try:
+                mode = os.stat(sys.argv[i]).st_mode
+            except OSError:
+                mode = 0
+
+            # if the argument is a directory, recursively check all the mkv files in the directory and convert them as a batch
+            if stat.S_ISDIR(mode):
+                status |= run_batch(find_mkv_files(sys.argv[i]), delete, audio_choice, remux, subtitle_choice)
             # otherwise, the argument is a file, so check if it is a valid mkv file and process it
             else:
                 filename = str(Path(sys.argv[i]))
                 print("Checking file: " + filename + " ...")
 
                 # check if the file exists
-                if not os.path.exists(filename) or not os.path.isfile(filename) or not os.access(filename, os.R_OK):
+                if not stat.S_ISREG(mode) or not os.access(filename, os.R_OK):
                     sys.exit(print_red("❌ "+filename+" does not exist"))
 
                 # check if the file is a mkv file
-                if not filename.endswith(".mkv") and not filename.endswith(".MKV"):
+                if not is_mkv(filename):
                     sys.exit(print_red("❌ "+filename+" is not a mkv file"))
 
-                process(filename, delete)
+                process(filename, delete, audio_choice, remux, subtitle_choice)
         except Exception as e:
             print_red("❌ Failed to process file: " + sys.argv[i])
             print_red("❌ Error: " + str(e))
             exit(1)
-    return 0
+    return status
 
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file